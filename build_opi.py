@@ -36,14 +36,23 @@ Example:
 from __future__ import print_function
 import re
 import sys
-import copy
+import string
+import keyword
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 
-import xml.etree.ElementTree as ET
+try:
+    # libxml2-backed parsing/serialization, when available
+    import lxml.etree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
 
 import epics
 
-templates = {}
+# Render functions for the serialized template widgets (see
+# compile_renderer) and their heights, keyed by widget name
+template_renderers = {}
+template_heights = {}
 rtype_groups = {'ai' : ('text', 'r'),
                 'ao' : ('text', 'w'),
 
@@ -65,80 +74,133 @@ rtype_groups = {'ai' : ('text', 'r'),
 
 group_to_template = '%(group)s_%(access)s_group'
 
-def read_template(fn):
-    global templates
-
+# %(name)s-style template fields, rewritten to {name} for str.format_map
+template_field_re = re.compile(r'%\((\w+)\)s')
+
+# --group arguments of the form '(.*)SUFFIX' '\1OTHER', which reduce to
+# plain string operations
+literal_group_re = re.compile(r'\^?\(\.\*\)([^\\^$.|?*+(){}\[\]]+)(\$?)')
+literal_replace_re = re.compile(r'\\(?:1(?![0-9])|g<1>)([^\\]*)')
+
+class BlankMissingDict(dict):
+    '''Formats fields missing from the widget info as empty strings'''
+    def __missing__(self, key):
+        return ''
+
+def to_format_string(text):
+    '''Convert %-style template text to a str.format string'''
+    text = text.replace('{', '{{').replace('}', '}}')
+    text = template_field_re.sub(r'{\1}', text)
+    return text.replace('%%', '%')
+
+def compile_renderer(text):
+    '''Specialize a str.format template into a function of its fields
+
+    The generated function takes the fields as keyword arguments and joins
+    them with the literal text, skipping format string parsing on each call.
+    Missing fields render as empty strings and other keywords are ignored.
+    '''
+    parts = []
+    fields = []
+    for literal, field, spec, conversion in string.Formatter().parse(text):
+        if literal:
+            parts.append(repr(literal))
+        if field is not None:
+            parts.append('_str(%s)' % field)
+            if field not in fields:
+                fields.append(field)
+
+    if not all(field.isidentifier() and not keyword.iskeyword(field) and
+               not field.startswith('_') for field in fields):
+        # Not usable as argument names; fall back to formatting the text
+        return lambda **info: text.format_map(BlankMissingDict(info))
+
+    args = ''.join("%s='', " % field for field in fields)
+    source = ('def render(*, %s_str=str, **_):\n'
+              '    return \'\'.join((%s, ))\n' % (args, ', '.join(parts)))
+    namespace = {}
+    exec(compile(source, '<template>', 'exec'), namespace)
+    return namespace['render']
+
+def read_template(fn, x_scale=1.0, y_scale=1.0):
     tree = ET.parse(fn)
     root = tree.getroot()
 
-    templates = dict((widget.find('name').text, {'widget': widget})
-                     for widget in root.findall('widget'))
-
-    for name, info in templates.items():
-        widget = info['widget']
-        height = int(widget.find('height').text)
+    widgets = dict((widget.find('name').text, widget)
+                   for widget in root.findall('widget'))
 
-        info['height'] = height
+    for widget in widgets.values():
         root.remove(widget)
-    return tree, root
 
-def find_all_subwidgets(widget):
-    for sub_widget in widget.findall('widget'):
-        yield sub_widget
-        for sub_sub in find_all_subwidgets(sub_widget):
-            yield sub_sub
+    prescale_templates(widgets, x_scale, y_scale)
 
-def scale_attributes(widget, attr, scale=1.0, type_=int):
-    widgets = [widget] + list(find_all_subwidgets(widget))
+    template_renderers.clear()
+    template_heights.clear()
+    for name, widget in widgets.items():
+        template_heights[name] = int(widget.find('height').text)
 
-    for w in widgets:
-        w_attr = w.find(attr)
-        value = type_(w_attr.text)
-        w_attr.text = str(int(value * scale))
-
-def add_widget(x, y, parent, widget_name, x_scale=1.0, y_scale=1.0,
-               spacing=5.0,
-               **info):
-    try:
-        widget = templates[widget_name]['widget']
-    except KeyError:
-        print('Template %s unavailable' % widget_name)
-        return y
-
-    widget = templates[widget_name]['widget']
-    widget = copy.deepcopy(widget)
+        # The position is filled in per widget instance, along with the PV
+        # information, such that the serialized text can be reused as-is
+        widget.find('x').text = '%(x)s'
+        widget.find('y').text = '%(y)s'
+        text = to_format_string(ET.tostring(widget, encoding='unicode'))
+        template_renderers[name] = compile_renderer(text)
+    return tree, root
 
-    sub_widgets = list(find_all_subwidgets(widget))
+def scale_attributes(widget, scales, type_=int):
+    '''Scale attributes of a widget and its sub-widgets in a single walk
+
+    scales maps attribute names to their scale factors.
+    '''
+    scales = list(scales.items())
+    for w in widget.iter('widget'):
+        for attr, scale in scales:
+            w_attr = w.find(attr)
+            value = type_(w_attr.text)
+            w_attr.text = str(int(value * scale))
+
+def prescale_templates(widgets, x_scale=1.0, y_scale=1.0):
+    '''Scale all template widgets once for the whole run'''
+    scales = {}
     if x_scale != 1.0:
-        scale_attributes(widget, 'x', x_scale, type_=int)
-        scale_attributes(widget, 'width', x_scale, type_=int)
+        scales.update(x=x_scale, width=x_scale)
 
     if y_scale != 1.0:
-        scale_attributes(widget, 'y', y_scale, type_=int)
-        scale_attributes(widget, 'height', y_scale, type_=int)
+        scales.update(y=y_scale, height=y_scale)
 
-    x = x * x_scale
-    y = y * y_scale
+    if not scales:
+        return
 
-    widget.find('x').text = str(int(x * x_scale))
-    widget.find('y').text = str(int(y * y_scale))
+    for widget in widgets.values():
+        scale_attributes(widget, scales, type_=int)
 
-    # Take the parsed xml, convert it to string
-    group_text = ET.tostring(widget)
+def add_widget(x, y, widget_name, spacing=5.0, **info):
+    '''Render a widget from a template at (x, y)
 
-    # Format it with all of the info
-    group_text = group_text % info
+    Returns (widget XML text, y position for the next widget); the text is
+    None if the template is unavailable.
+    '''
+    render = template_renderers.get(widget_name)
+    if render is None:
+        print('Template %s unavailable' % widget_name)
+        return None, y
 
-    # Convert back to xml and insert into the parent node
-    new_node = ET.fromstring(group_text)
-    parent.append(new_node)
+    info['x'] = int(x)
+    info['y'] = int(y)
 
-    return y + spacing + int(widget.find('height').text)
+    # Render the pre-serialized template with all of the info; the caller
+    # parses it and inserts it into the display
+    group_text = render(**info)
+    return group_text, y + spacing + template_heights[widget_name]
 
 def make_display(root, pvs, x=0, y=0, title='', macros={},
                  sort='', **info):
+    # Widgets are rendered to text, then parsed and added to the display in
+    # one go at the end
+    fragments = []
     if title:
-        y = add_widget(x, y, root, 'title_group', title=title, **info)
+        text, y = add_widget(x, y, 'title_group', title=title, **info)
+        fragments.append(text)
 
     if macros:
         m = root.find('macros')
@@ -159,38 +221,86 @@ def make_display(root, pvs, x=0, y=0, title='', macros={},
         pvs.sort(key=lambda item: item[sort_key])
 
     for pv_info in pvs:
-        pv_info = copy.deepcopy(pv_info)
-        pv_info.update(info)
-        y = add_widget(x, y, root, pv_info['template'], **pv_info)
-
+        # Values are all strings, so a shallow merge is sufficient
+        pv_info = dict(pv_info, **info)
+        text, y = add_widget(x, y, pv_info['template'], **pv_info)
+        fragments.append(text)
+
+    holder = ET.fromstring('<widgets>%s</widgets>' %
+                           ''.join(text for text in fragments
+                                   if text is not None))
+    root.extend(list(holder))
     return y
 
+class Macros(dict):
+    '''Macro name to value mapping, with single-pass substitution
+
+    The patterns matching all macro values and names are compiled once on
+    creation, so the mapping should not be modified afterward.
+    '''
+    def __init__(self, *args, **kwargs):
+        super(Macros, self).__init__(*args, **kwargs)
+
+        self._names = dict((to, from_) for from_, to in self.items() if to)
+        # Longest values first, so a value that is a prefix of another does
+        # not shadow it
+        values = sorted(self._names, key=len, reverse=True)
+        self._value_re = None
+        if values:
+            self._value_re = re.compile('|'.join(re.escape(to)
+                                                 for to in values))
+
+        self._name_re = None
+        if self:
+            names = '|'.join(re.escape(name) for name in self)
+            self._name_re = re.compile(r'\$[({](%s)[)}]' % names)
+
+    def _to_macro(self, m):
+        return '$(%s)' % self._names[m.group(0)]
+
+    def _to_value(self, m):
+        return self[m.group(1)]
+
+    def sub(self, text):
+        '''Replace macro values in text with $(name)'''
+        if self._value_re is None:
+            return text
+        return self._value_re.sub(self._to_macro, text)
+
+    def expand(self, text):
+        '''Expand $(name) and ${name} in text'''
+        if self._name_re is None:
+            return text
+        return self._name_re.sub(self._to_value, text)
+
 def sub_macros(text, macros):
-    for from_, to in macros.items():
-        text = text.replace(to, '$(%s)' % from_)
-    return text
+    if not isinstance(macros, Macros):
+        macros = Macros(macros)
+    return macros.sub(text)
 
 def expand_macros(text, macros):
-    for from_, to in macros.items():
-        text = re.sub('\$[({]%s[)}]' % from_, to, text)
-    return text
+    if not isinstance(macros, Macros):
+        macros = Macros(macros)
+    return macros.expand(text)
 
-def get_pv_info(macros, pvs=(), rtype=(), description=''):
+def get_pv_info(macros, pvs=(), rtype=(), description='', descriptions={}):
     ret = {}
+    if not isinstance(macros, Macros):
+        macros = Macros(macros)
     if isinstance(pvs, str):
         pvs = (pvs, )
 
-    if not rtype or len(rtype) != 2:
+    if not rtype or len(rtype) != len(pvs):
         if not macros:
             raise ValueError('Macros must be set to determine record types')
 
-        rtype = [epics.caget('%s.RTYP' % expand_macros(pv, macros))
+        rtype = [epics.caget('%s.RTYP' % macros.expand(pv))
                  for pv in pvs]
 
     try:
         rtype_info = [rtype_groups[rt] for rt in rtype]
-    except KeyError:
-        print('Unknown record type: %s' % rt)
+    except KeyError as ex:
+        print('Unknown record type: %s' % ex)
         return
 
     groups = [rt[0] for rt in rtype_info]
@@ -221,11 +331,15 @@ def get_pv_info(macros, pvs=(), rtype=(), description=''):
         raise ValueError('Need either readback/setpoint pv')
 
     if not description and macros:
-        pv = expand_macros(desc_pv, macros)
-        pv_desc = epics.caget('%s.DESC' % pv, timeout=0.1)
+        if desc_pv in descriptions:
+            pv_desc = descriptions[desc_pv]
+        else:
+            pv = macros.expand(desc_pv)
+            pv_desc = epics.caget('%s.DESC' % pv, timeout=0.1)
+
         if pv_desc is not None:
             description = pv_desc
-    else:
+    elif not description:
         description = readback_pv
 
     template = group_to_template % locals()
@@ -238,11 +352,60 @@ def get_pv_info(macros, pvs=(), rtype=(), description=''):
           (readback_pv, setpoint_pv, rtype, description, template))
     return ret
 
-def display_from_pv_list(macros={}, others=[], groups=[], template='template.opi', **kwargs):
-    tree, root = read_template(template)
-
-    info = [get_pv_info(macros, pvs=pv) for pv in
-                        others + groups]
+def caget_fields(pvs, field, macros, **kwargs):
+    '''Get a field of all PVs concurrently, keyed on the (unexpanded) PV'''
+    if not isinstance(macros, Macros):
+        macros = Macros(macros)
+    names = ['%s.%s' % (macros.expand(pv), field) for pv in pvs]
+    return dict(zip(pvs, epics.caget_many(names, **kwargs)))
+
+def description_pv(pv_set, rtypes):
+    '''The PV get_pv_info takes the description from: readback over setpoint'''
+    for access in ('r', 'w'):
+        for pv in pv_set:
+            rtype_info = rtype_groups.get(rtypes.get(pv))
+            if rtype_info is not None and rtype_info[1] == access:
+                return pv
+
+def caget_pv_sets(pv_sets, macros):
+    '''Get record types for all PVs, then only the descriptions used
+
+    Returns (rtypes, descriptions), both keyed on the (unexpanded) PV.
+    '''
+    all_pvs = [pv for pv_set in pv_sets for pv in pv_set]
+    rtypes = caget_fields(all_pvs, 'RTYP', macros)
+
+    desc_pvs = [description_pv(pv_set, rtypes) for pv_set in pv_sets]
+    descriptions = caget_fields([pv for pv in desc_pvs if pv is not None],
+                                'DESC', macros, timeout=0.1)
+    return rtypes, descriptions
+
+def display_from_pv_list(macros={}, others=[], groups=[], template='template.opi',
+                         x_scale=1.0, y_scale=1.0, **kwargs):
+    macros = Macros(macros)
+    pv_sets = [(pv, ) for pv in others] + list(groups)
+    fetch = bool(pv_sets and macros)
+
+    rtypes = {}
+    descriptions = {}
+    # Issue the channel access requests for all PVs at once, rather than
+    # waiting on a round-trip per PV in get_pv_info. They run in the
+    # background while the template is read; the worker thread has to share
+    # the main channel access context.
+    with ThreadPoolExecutor(max_workers=1,
+                            initializer=epics.ca.use_initial_context) as executor:
+        if fetch:
+            future = executor.submit(caget_pv_sets, pv_sets, macros)
+
+        tree, root = read_template(template, x_scale=x_scale, y_scale=y_scale)
+
+        if fetch:
+            rtypes, descriptions = future.result()
+
+    info = [get_pv_info(macros, pvs=pv_set,
+                        rtype=[rtypes[pv] for pv in pv_set if pv in rtypes],
+                        descriptions=descriptions)
+            for pv_set in pv_sets]
 
     info = [pvinfo for pvinfo in info
             if pvinfo is not None]
@@ -251,42 +414,76 @@ def display_from_pv_list(macros={}, others=[], groups=[], template='template.opi
 
     return tree
 
+def group_rewriter(pattern, replace):
+    '''Create a function giving the PV name a PV should be grouped with
+
+    Equivalent to pattern.sub(replace, pv), but skips the regular expression
+    engine for literal suffix patterns such as '(.*)_IN' -> '\1_OUT'.
+    '''
+    pattern_m = literal_group_re.fullmatch(pattern.pattern)
+    replace_m = literal_replace_re.fullmatch(replace)
+    if pattern_m is None or replace_m is None or pattern.flags != re.UNICODE:
+        return lambda pv: pattern.sub(replace, pv)
+
+    suffix, anchored = pattern_m.groups()
+    new_suffix = replace_m.group(1)
+
+    if anchored:
+        def rewrite(pv):
+            if pv.endswith(suffix):
+                return pv[:-len(suffix)] + new_suffix
+            return pv
+    else:
+        # (.*) is greedy, so the last occurrence of the suffix is replaced
+        def rewrite(pv):
+            idx = pv.rfind(suffix)
+            if idx >= 0:
+                return pv[:idx] + new_suffix + pv[idx + len(suffix):]
+            return pv
+
+    return rewrite
+
+def partition_groups(pvs, rewrite):
+    '''Split PVs into (ungrouped PVs, [(pv, grouped_pv), ...])'''
+    # Only PVs that the rewrite changes can start a group, and each PV may
+    # only be in one group. The set gives O(1) membership tests while pvs
+    # keeps the original ordering.
+    ungrouped = set(pvs)
+    groups = []
+    for pv1, pv2 in zip(pvs, map(rewrite, pvs)):
+        if pv1 != pv2 and pv2 in ungrouped and pv1 in ungrouped:
+            ungrouped.discard(pv1)
+            ungrouped.discard(pv2)
+            groups.append((pv1, pv2))
+
+    others = [pv for pv in pvs if pv in ungrouped]
+    return others, groups
+
 def main(pv_list='/epics/pv_lists/iocanc300.txt',
          output='output.opi',
          macros={}, group_pattern=None,
-         ignore=[], title='title',
+         ignore=None, title='title',
          substitute=[], **kwargs):
 
-    def sub_pv(pv):
-        if substitute:
-            pat, sub = substitute
-            return re.sub(pat, sub, pv)
-        else:
-            return pv
+    # One PV per line, skipping blank lines
+    with open(pv_list, 'rt') as f:
+        pvs = [line.strip() for line in f.read().splitlines() if line.strip()]
 
-    pvs = [line.strip() for line in open(pv_list, 'rt').readlines()]
-    pvs = [sub_pv(pv) for pv in pvs]
-    pvs = [sub_macros(pv, macros) for pv in pvs]
+    # Each stage is applied to the whole list at once, with the checks for
+    # whether it applies at all hoisted out of the per-PV loop
+    if substitute:
+        pat, sub = substitute
+        pvs = [pat.sub(sub, pv) for pv in pvs]
 
-    for pattern in ignore:
-        for pv in list(pvs):
-            m = re.search(pattern, pv)
-            if m is not None:
-                pvs.remove(pv)
-                continue
+    macros = Macros(macros)
+    if macros:
+        pvs = [macros.sub(pv) for pv in pvs]
 
-    others = pvs
-    groups = []
-    pattern, replace = group_pattern
-    for pv1 in list(others):
-        if isinstance(pv1, tuple):
-            continue
-
-        pv2 = re.sub(pattern, replace, pv1)
-        if pv1 != pv2 and pv2 in others:
-            others.remove(pv1)
-            others.remove(pv2)
-            groups.append((pv1, pv2))
+    if ignore:
+        pvs = [pv for pv in pvs
+               if not any(pattern.search(pv) for pattern in ignore)]
+
+    others, groups = partition_groups(pvs, group_rewriter(*group_pattern))
 
     print('unclassified ', '\n\t'.join(others))
     print('groups ', '\n\t'.join(str(group) for group in groups))
@@ -295,14 +492,15 @@ def main(pv_list='/epics/pv_lists/iocanc300.txt',
                                 **kwargs)
 
     print('Outputting to %s' % output)
-    tree.write(output)
+    with open(output, 'wb', buffering=1 << 20) as f:
+        tree.write(f, encoding='utf-8', xml_declaration=True)
 
 def parse_macro_string(m):
     macros = {}
     for entry in m.split(','):
         var, value = entry.split('=')
         macros[var] = value
-    return macros
+    return Macros(macros)
 
 #(r'(.*)_IN$', r'\1_OUT', ),
 if __name__ == '__main__':
@@ -334,11 +532,21 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
     macros = parse_macro_string(args.macros)
+
+    # Compile user-supplied patterns once up front, not per PV
+    ignore = [re.compile(pattern) for pattern in args.ignore or []]
+    substitute = []
+    if args.substitute:
+        pattern, sub = args.substitute
+        substitute = [re.compile(pattern), sub]
+    pattern, replace = args.group
+    group_pattern = (re.compile(pattern), replace)
+
     print('Input:', args.pv_list_file)
     print('Output:', args.output_file)
     print('Template:', args.template)
     main(args.pv_list_file, args.output_file,
-         ignore=args.ignore,
-         substitute=args.substitute, group_pattern=args.group,
+         ignore=ignore,
+         substitute=substitute, group_pattern=group_pattern,
          title=args.title, macros=macros, sort=args.sort,
          x_scale=args.scalex, y_scale=args.scaley, template=args.template)